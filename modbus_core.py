@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+modbus_core.py
+
+Modbus RTU helpers shared by the bridges and raw_modbus_test.py:
+CRC16, frame builders, the serial transaction helper, response parsing
+and hex formatting.
+
+Register map (relay board manual):
+  0x0001 - 0x0008  outputs (write 0x0100 = open/ON, 0x0200 = close/OFF)
+  0x0081 - 0x0088  inputs
+"""
+
+import struct
+
+# -------------------
+# MODBUS CONSTANTS
+# -------------------
+WRITE_REG = 0x06
+READ_REG  = 0x03
+WRITE_MULTI = 0x10
+
+# slave id, function code, register address, register value / quantity
+pack_frame = struct.Struct(">BBHH").pack
+
+# Response sizes: FC 0x06/0x10 echo 8 bytes, FC 0x03 is 5 + 2 per register
+WRITE_RESP_LEN = 8
+
+def read_resp_len(qty):
+    return 5 + 2 * qty
+
+# -------------------
+# CRC16
+# -------------------
+def _crc16_entry(byte):
+    crc = byte
+    for _ in range(8):
+        if crc & 1:
+            crc = (crc >> 1) ^ 0xA001
+        else:
+            crc >>= 1
+    return crc
+
+# Modbus CRC16 (poly 0xA001), one entry per byte value
+CRC16_TABLE = tuple(_crc16_entry(i) for i in range(256))
+
+def crc16(data: bytes):
+    crc = 0xFFFF
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc.to_bytes(2, byteorder='little')
+
+try:
+    # Optional: compiled Modbus CRC replaces the lookup table version
+    from fastcrc import crc16 as fastcrc16
+except ImportError:
+    pass
+else:
+    def crc16(data: bytes):
+        return fastcrc16.modbus(data).to_bytes(2, byteorder='little')
+
+# -------------------
+# HEX HELPERS
+# -------------------
+def hexdump(b):
+    return b.hex(' ').upper()
+
+# Whitespace stripped from hex strings in a single pass
+_HEX_WS = str.maketrans('', '', ' \n\r\t')
+
+def hexstr_to_bytes(s):
+    return bytes.fromhex(s.translate(_HEX_WS))
+
+# -------------------
+# FRAME BUILDERS
+# -------------------
+def build_relay_command(device, channel, action):
+    if channel < 1 or channel > 8:
+        raise ValueError("channel must be 1-8")
+
+    # 01 = open (ON), 02 = close (OFF)
+    if action == "on":
+        data = 0x0100
+    elif action == "off":
+        data = 0x0200
+    else:
+        raise ValueError("action must be 'on' or 'off'")
+
+    frame = pack_frame(device, WRITE_REG, channel, data)
+    return frame + crc16(frame)
+
+def build_read_input(device, input_num):
+    if input_num < 1 or input_num > 8:
+        raise ValueError("input must be 1-8")
+
+    frame = pack_frame(device, READ_REG, 0x0080 + input_num, 0x0001)
+    return frame + crc16(frame)
+
+def build_read_output(device, output_num):
+    if output_num < 1 or output_num > 8:
+        raise ValueError("output must be 1-8")
+
+    frame = pack_frame(device, READ_REG, output_num, 0x0001)
+    return frame + crc16(frame)
+
+def build_write_multiple(device, start_addr, values):
+    # FC 0x10: header, byte count, then the register values
+    qty = len(values)
+    frame = struct.pack(
+        f">BBHHB{qty}H",
+        device, WRITE_MULTI, start_addr, qty, 2 * qty, *values
+    )
+    return frame + crc16(frame)
+
+def build_read_multi(device, start_addr, qty):
+    frame = pack_frame(device, READ_REG, start_addr, qty)
+    return frame + crc16(frame)
+
+def build_frames(device):
+    # Every frame the bridges can send, built once per device
+    frames = {}
+    for ch in range(1, 9):
+        frames[("out", ch, "on")] = build_relay_command(device, ch, "on")
+        frames[("out", ch, "off")] = build_relay_command(device, ch, "off")
+        frames[("in", ch)] = build_read_input(device, ch)
+        frames[("outread", ch)] = build_read_output(device, ch)
+    # Whole-board frames: 0x0100 = open (ON), 0x0200 = close (OFF)
+    frames[("out", "all", "on")] = build_write_multiple(device, 0x0001, [0x0100] * 8)
+    frames[("out", "all", "off")] = build_write_multiple(device, 0x0001, [0x0200] * 8)
+    frames[("in", "all")] = build_read_multi(device, 0x0081, 8)
+    frames[("outread", "all")] = build_read_multi(device, 0x0001, 8)
+    return frames
+
+# -------------------
+# SERIAL
+# -------------------
+# False until a transaction got its full reply; the first one always flushes
+last_ok = False
+
+def transact(ser, frame, expected_len):
+    # pyserial returns as soon as expected_len bytes arrived (or on timeout)
+    global last_ok
+    # Request/response on a half-duplex line: after a complete reply the
+    # input buffer is already empty, so only flush after a short read.
+    if not last_ok:
+        ser.reset_input_buffer()
+    # Stays False if write/read raises, so the next transaction flushes
+    last_ok = False
+    ser.write(frame)
+    resp = ser.read(expected_len)
+    last_ok = len(resp) == expected_len
+    return resp
+
+# -------------------
+# RESPONSE PARSING
+# -------------------
+def parse_states(resp, qty):
+    # Register values start at resp[3]; the low byte is 1 when ON.
+    # A short reply, an exception reply or a wrong byte count is rejected
+    # as a whole rather than decoded into bogus channel states.
+    if len(resp) < 3 + 2 * qty or resp[1] != READ_REG or resp[2] != 2 * qty:
+        return None
+    return [resp[4 + 2 * i] == 1 for i in range(qty)]
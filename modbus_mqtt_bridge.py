@@ -12,12 +12,31 @@ By default it tries:
  - Channel 1 OPEN : 01 06 00 01 01 00 D9 9A (example from your manual)
  - Read Channel 1 : 01 03 00 01 00 01 D5 CA
 Change --baud --slave if needed.
+
+Threading: paho runs its network loop in the background (loop_start) and
+on_message only queues the command. The main thread pops commands and
+does the serial I/O one transaction at a time (RS-485 is half-duplex),
+reading each reply by its known length instead of sleeping.
 """
 import serial
 import argparse
-import time
 import sys
+import queue
+import logging
 import paho.mqtt.client as mqtt
+from modbus_core import (
+    WRITE_RESP_LEN,
+    build_frames,
+    build_read_input,
+    build_relay_command,
+    hexdump,
+    parse_states,
+    read_resp_len,
+    transact,
+)
+
+# Per-message traces; only emitted with --debug
+log = logging.getLogger('bridge')
 
 
 # -------------------
@@ -32,14 +51,14 @@ def on_connect(client, userdata, flags, reason_code, properties):
     client.publish("george/test/board/response", "Modbus RTU tester connected.", qos=1)
 
 def on_publish(client, userdata, mid):
-    print("Message published! MID:", mid)
+    log.debug("Message published! MID: %s", mid)
 
 def on_message(client, userdata, message):
 
     text = message.payload.decode().strip()
     incoming = text.lower()
 
-    print(f"Received: {text}")
+    log.debug("Received: %s", text)
 
     # 1️⃣ Do NOT reply to own messages
     # We tag our own messages with a prefix
@@ -54,19 +73,13 @@ def on_message(client, userdata, message):
         reply = "Goodbye!"
 
     else:
-        process_command(incoming)
+        # Serial I/O happens on the worker, not on the MQTT network thread
+        command_queue.put(incoming)
 
     # 3️⃣ Publish reply with a tag so we don't reply to ourselves
     #client.publish("george/test/board", "from-subscriber: " + reply)
     #print("Replied:", reply)
 
-WRITE_REG = 0X06
-READ_REG  = 0X03
-
-def hexstr_to_bytes(s):
-    s = s.replace(' ','').replace('\n','')
-    return bytes.fromhex(s)
-
 # Common example frames from your manual (slave=1)
 EXAMPLES = {
     'chan1_open' : "01 06 00 01 01 00 D9 9A",
@@ -74,199 +87,132 @@ EXAMPLES = {
     'read_ch1'   : "01 03 00 01 00 01 D5 CA",
     'remove realationship': "01 06 00 FD 00 00 18 3A",
 }
-def crc16(data: bytes):
-    crc = 0xFFFF
-    for byte in data:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 1:
-                crc = (crc >> 1) ^ 0xA001
-            else:
-                crc >>= 1
-    return crc.to_bytes(2, byteorder='little')
-
-# Relay control base (no CRC yet)
-def build_relay_command(device, channel, action):
-    # channel: 1-8  → convert to register address
-    reg_hi = 0x00
-    reg_lo = channel  # 1..8
-
-    # action code from manual
-    # 01 = open (ON), 02 = close (OFF)
-    if action == "on":
-        data_hi, data_lo = 0x01, 0x00
-    elif action == "off":
-        data_hi, data_lo = 0x02, 0x00
-    else:
-        raise ValueError("action must be 'on' or 'off'")
-    
-    if channel > 8 or channel < 1:
-        raise ValueError("channel must be 1-8")
-
-    frame_wo_crc = bytes([device, WRITE_REG, reg_hi, reg_lo, data_hi, data_lo])
-
-    print("Frame without CRC:", hexdump(frame_wo_crc))
-    crc = crc16(frame_wo_crc)
-    return frame_wo_crc + crc
-
-
-def build_read_input(device, input_num):
-    # Inputs are 0x0081 - 0x0088
-    addr = 0x0080 + input_num
-    frame_wo_crc = bytes([
-        device,      # slave
-        READ_REG,      # read command
-        (addr >> 8) & 0xFF,
-        addr & 0xFF,
-        0x00, 0x01 # read one register
-    ])
-    crc = crc16(frame_wo_crc)
-    return frame_wo_crc + crc
-
-def builst_read_output(device, output_num):
-    # Outputs are 0x0001 - 0x0008
-    addr = output_num
-    frame_wo_crc = bytes([
-        device,      # slave
-        READ_REG,      # read command
-        (addr >> 8) & 0xFF,
-        addr & 0xFF,
-        0x00, 0x01 # read one register
-    ])
-    crc = crc16(frame_wo_crc)
-    return frame_wo_crc + crc
-
-def hexdump(b):
-    return ' '.join(f"{x:02X}" for x in b)
-
-def print_pubish(*args, **kwargs):
+
+command_queue = queue.Queue()
+
+def serial_worker():
+    # Runs on the main thread so "exit" can still end the program
+    while True:
+        cmd = command_queue.get()
+        process_command(cmd)
+
+def print_pubish(*args, qos=0):
+    # Readings go out with QoS 0; acks and errors pass qos=1
     text = ' '.join(str(a) for a in args)
     if isinstance(args[0], list):
         text = ' '.join(str(a) for a in args[0])
-    client.publish("george/test/board/response", text, qos=1)
-    print("Publishing message:", text)
-
-
-def process_command(cmd):
-    messages = []
-    
-    if cmd == "on all" or cmd == "off all" or cmd.startswith("out ") or cmd.startswith("in ") or cmd.startswith("status "):
-        messages.append(f"Processing command: {cmd}")
- 
-    if cmd == "exit":
-        print_pubish("Exiting program as requested.")
-        sys.exit(0)
-
-    print_pubish("You typed: ", cmd)
-
-    parts = cmd.split()
-    if len(parts) == 3 and parts[0] == "out":
-        ch = int(parts[1])
-        state = parts[2]
-        print(device_selected, ch, state)
-        time.sleep(1)
-        frame = build_relay_command(device_selected, ch, state)
-        ser.reset_input_buffer()
-        ser.write(frame)
-        time.sleep(0.1)
-        resp = ser.read(256)
-        print_pubish("<- Response:", hexdump(resp))
-    elif cmd == "on all":
-        for i in range(1, 9):
-            frame = build_relay_command(device_selected, i, "on")
-            ser.reset_input_buffer()    
-            ser.write(frame)
-            time.sleep(0.01)
-            resp = ser.read(256)
-            if len(resp) > 0:
-                messages.append(f"Channel {i} ON response: {hexdump(resp)}")
-            else:
-                messages.append(f"Channel {i} No response (timeout)")
-        final_text = "\n".join(messages)
-        print_pubish(final_text)
-    elif cmd == "off all":
-        for i in range(1, 9):
-            frame = build_relay_command(device_selected, i, "off")
-            ser.reset_input_buffer()
-            ser.write(frame)
-            time.sleep(0.01)
-            resp = ser.read(256)
-            if len(resp) > 0:
-                messages.append(f"Channel {i} OFF response: {hexdump(resp)}")
+    client.publish("george/test/board/response", text, qos=qos)
+    log.debug("Publishing message: %s", text)
+
+
+def handle_out(cmd, args):
+    if len(args) != 2:
+        return handle_invalid(cmd, args)
+    ch = int(args[0])
+    state = args[1]
+    log.debug("out: device %s channel %s %s", device_selected, ch, state)
+    frame = FRAMES.get(('out', ch, state)) or build_relay_command(device_selected, ch, state)
+    resp = transact(ser, frame, WRITE_RESP_LEN)
+    print_pubish("<- Response:", hexdump(resp), qos=1)
+
+def handle_all(cmd, args):
+    # "on all" / "off all"
+    if args != ["all"]:
+        return handle_invalid(cmd, args)
+    messages = [f"Processing command: {cmd}"]
+    state = cmd.split()[0]
+    frame = FRAMES[('out', 'all', state)]
+    resp = transact(ser, frame, WRITE_RESP_LEN)
+    if len(resp) > 0:
+        messages.append(f"Channels 1-8 {state.upper()} response: {hexdump(resp)}")
+    else:
+        messages.append("Channels 1-8: No response (timeout)")
+    final_text = "\n".join(messages)
+    print_pubish(final_text, qos=1)
+
+def handle_in(cmd, args):
+    if len(args) != 1:
+        return handle_invalid(cmd, args)
+    inp = int(args[0])
+    frame = FRAMES.get(('in', inp)) or build_read_input(device_selected, inp)
+    resp = transact(ser, frame, read_resp_len(1))
+    states = parse_states(resp, 1)
+    if states is not None:
+        print_pubish(f"Input {inp} is {'ON' if states[0] else 'OFF'}")
+    elif len(resp) > 0:
+        # short or exception reply
+        print_pubish("<- Bad response:", hexdump(resp), qos=1)
+    else:
+        print_pubish("<- No response (timeout).", qos=1)
+
+def handle_status(cmd, args):
+    # "status out" / "status inp"
+    if args == ["out"]:
+        frame = FRAMES[('outread', 'all')]
+    elif args == ["inp"]:
+        frame = FRAMES[('in', 'all')]
+    else:
+        return handle_invalid(cmd, args)
+    messages = [f"Processing command: {cmd}"]
+    resp = transact(ser, frame, read_resp_len(8))
+    states = parse_states(resp, 8)
+    for i in range(1, 9):
+        if states is not None:
+            if states[i - 1]:
+                messages.append(f"Input {i} is ON")
             else:
-                messages.append(f"Channel {i}: No response (timeout)")
-        final_text = "\n".join(messages)
-        print_pubish(final_text)    
-        
-    elif len(parts) == 2 and parts[0] == "in":
-        inp = int(parts[1])
-        frame = build_read_input(device_selected, inp)
-        ser.reset_input_buffer()
-        ser.write(frame)
-        time.sleep(0.1)
-        resp = ser.read(256)
-        if len(resp) > 0:
-            # print_pubish("<- Response:", hexdump(resp)) 
-            print_pubish(f"Input {inp} is {"ON" if resp[4] == 1 else "OFF"}")
+                messages.append(f"Input {i} is OFF")
         else:
-            print_pubish("<- No response (timeout).")
-
-    elif cmd == "status out":
-        for i in range(1, 9):
-            frame = builst_read_output(device_selected, i)
-            ser.reset_input_buffer()
-            ser.write(frame)
-            time.sleep(0.1)
-            resp = ser.read(256)
-            size = len(resp)
-            if size > 0:
-                if resp[4] == 1:
-                    messages.append(f"Input {i} is ON")
-                else:
-                    messages.append(f"Input {i} is OFF")
-            else:
-                messages.append(f"Input {i}: No response (timeout)")
-
-        final_text = "\n".join(messages)
-        print_pubish(final_text)
-
-    elif cmd == "status inp":
-        for i in range(1, 9):
-            frame = build_read_input(device_selected, i)
-            ser.reset_input_buffer()
-            ser.write(frame)
-            time.sleep(0.1)
-            resp = ser.read(256)
-            size = len(resp)
-            if size > 0:
-                if resp[4] == 1:
-                    messages.append(f"Input {i} is ON")
-                else:
-                    messages.append(f"Input {i} is OFF")
-            else:
-                messages.append(f"Input {i}: No response (timeout)")
-
-        final_text = "\n".join(messages)
-        print_pubish(final_text)
-    else:
-        print_pubish("Invalid command format.")
+            messages.append(f"Input {i}: No response (timeout)")
+
+    final_text = "\n".join(messages)
+    print_pubish(final_text)
+
+def handle_exit(cmd, args):
+    print_pubish("Exiting program as requested.", qos=1)
+    sys.exit(0)
+
+def handle_invalid(cmd, args):
+    print_pubish("Invalid command format.", qos=1)
+
+# First word of the command -> handler(cmd, remaining words)
+HANDLERS = {
+    "out": handle_out,
+    "in": handle_in,
+    "on": handle_all,
+    "off": handle_all,
+    "status": handle_status,
+    "exit": handle_exit,
+}
 
+def process_command(cmd):
+    verb, *args = cmd.split() or [""]
+    handler = HANDLERS.get(verb, handle_invalid)
+    if handler is not handle_exit:
+        print_pubish("You typed: ", cmd)
+    try:
+        handler(cmd, args)
+    except ValueError as e:
+        # bad channel number / action
+        print_pubish("Invalid command:", e, qos=1)
 
-    
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--port', required=True, help='COM port, e.g. COM16')
     p.add_argument('--device', type=int, default=1, help='slave device id')
     p.add_argument('--baud', type=int, default=9600, help='baud rate')
-    p.add_argument('--timeout', type=float, default=0.1, help='serial timeout (s)')
+    p.add_argument('--timeout', type=float, default=0.05, help='serial timeout (s)')
+    p.add_argument('--debug', action='store_true', help='log every command / response')
     args = p.parse_args()
 
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
     print("Raw Modbus RTU test")
     print("Port:", args.port, "Baud:", args.baud, "Timeout:", args.timeout)
     try:
         global ser
-        ser = serial.Serial(port=args.port, baudrate=args.baud, bytesize=8, parity='N', stopbits=1, timeout=args.timeout)
+        ser = serial.Serial(port=args.port, baudrate=args.baud, bytesize=8, parity='N', stopbits=1, timeout=args.timeout, inter_byte_timeout=0.002)
     except Exception as e:
         print("Failed to open serial port:", e)
         return
@@ -274,6 +220,9 @@ def main():
     global device_selected
     device_selected = args.device
 
+    global FRAMES
+    FRAMES = build_frames(device_selected)
+
     print("Using slave device ID:", device_selected)
 
     print("\n--- Interactive Mode ---")
@@ -296,7 +245,8 @@ def main():
     client.on_message = on_message
 
     client.connect("yurir.org", 1883, 60)
-    client.loop_forever()
+    client.loop_start()
+    serial_worker()
 
 
  #   cmd = input("Command> ").strip().lower()
@@ -9,201 +9,317 @@ MQTT CMD topic:
 
 MQTT RESPONSE topic:
   george/test/board/response
+
+Threading:
+  paho network loop  -> background thread (loop_start), only queues commands
+  serial_worker      -> main thread, one Modbus transaction at a time
+                        (RS-485 is half-duplex), no fixed sleeps
+                        queued back-to-back commands are coalesced
+                        (adjacent outputs -> FC 0x10, repeated status -> one read)
 """
 
 import serial
 import argparse
-import time
 import sys
 import json
+import queue
 import paho.mqtt.client as mqtt
+from modbus_core import (
+    WRITE_RESP_LEN,
+    build_frames,
+    build_read_input,
+    build_relay_command,
+    build_write_multiple,
+    hexdump,
+    parse_states,
+    read_resp_len,
+    transact,
+)
+
+try:
+    # Optional: C JSON encoder/decoder, falls back to the stdlib one
+    import orjson
+except ImportError:
+    orjson = None
 
 # -------------------
-# MODBUS CONSTANTS
-# -------------------
-WRITE_REG = 0x06
-READ_REG  = 0x03
-
-# -------------------
-# CRC16
+# WORKER
 # -------------------
-def crc16(data: bytes):
-    crc = 0xFFFF
-    for byte in data:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 1:
-                crc = (crc >> 1) ^ 0xA001
-            else:
-                crc >>= 1
-    return crc.to_bytes(2, byteorder='little')
-
-def hexdump(b):
-    return ' '.join(f"{x:02X}" for x in b)
-
-# -------------------
-# FRAME BUILDERS
-# -------------------
-def build_relay_command(device, channel, action):
-    if channel < 1 or channel > 8:
-        raise ValueError("channel must be 1-8")
-
-    if action == "on":
-        data_hi, data_lo = 0x01, 0x00
-    elif action == "off":
-        data_hi, data_lo = 0x02, 0x00
-    else:
-        raise ValueError("action must be 'on' or 'off'")
-
-    frame = bytes([
-        device,
-        WRITE_REG,
-        0x00,
-        channel,
-        data_hi,
-        data_lo
-    ])
-    return frame + crc16(frame)
-
-def build_read_input(device, input_num):
-    addr = 0x0080 + input_num
-    frame = bytes([
-        device,
-        READ_REG,
-        (addr >> 8) & 0xFF,
-        addr & 0xFF,
-        0x00,
-        0x01
-    ])
-    return frame + crc16(frame)
-
-def build_read_output(device, output_num):
-    frame = bytes([
-        device,
-        READ_REG,
-        0x00,
-        output_num,
-        0x00,
-        0x01
-    ])
-    return frame + crc16(frame)
+command_queue = queue.Queue()
+
+# Max commands drained from the queue and coalesced into one pass
+BATCH_SIZE = 8
+
+def serial_worker():
+    while True:
+        batch = [command_queue.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(command_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Nothing else pending: no batching machinery for a single command
+        if len(batch) == 1:
+            process_command(batch[0])
+        else:
+            process_batch(batch)
 
 # -------------------
 # MQTT HELPERS
 # -------------------
-def publish_json(obj):
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+def loads(payload):
+    # Both parsers accept the raw bytes payload directly
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+# Fixed payloads, encoded once
+ONLINE_MSG = dumps({"status": "online"})
+UNKNOWN_COMMAND_MSG = dumps({"result": "error", "message": "Unknown command"})
+INVALID_JSON_MSG = dumps({"error": "Invalid JSON"})
+
+def publish_json(obj, qos=0):
+    # obj may be a pre-encoded payload (bytes).
+    # Readings go out with QoS 0; acks and errors pass qos=1.
     client.publish(
         "george/test/board/response",
-        json.dumps(obj, indent=2),
-        qos=1
+        obj if isinstance(obj, bytes) else dumps(obj),
+        qos=qos
     )
 
 # -------------------
 # COMMAND PROCESSOR
 # -------------------
-def process_command(data):
-    cmd = data.get("cmd")
+# ---------------- output single ----------------
+def handle_output(data):
+    ch = data["channel"]
+    state = data["state"]
+    # 1.0 and true hash like 1 and would hit the FRAMES entry for relay 1
+    if type(ch) is not int:
+        raise ValueError("channel must be an integer")
+
+    frame = (
+        FRAMES.get(("out", ch, state))
+        or build_relay_command(device_selected, ch, state)
+    )
+    resp = transact(ser, frame, WRITE_RESP_LEN)
+
+    publish_json({
+        "result": "ok",
+        "cmd": "output",
+        "channel": ch,
+        "state": state,
+        "response": hexdump(resp)
+    }, qos=1)
+
+# ---------------- output all ----------------
+def handle_output_all(data):
+    state = data["state"]
+    if state not in ("on", "off"):
+        raise ValueError("action must be 'on' or 'off'")
 
-    try:
-        # ---------------- output single ----------------
-        if cmd == "output":
-            ch = data["channel"]
-            state = data["state"]
-
-            frame = build_relay_command(device_selected, ch, state)
-            ser.reset_input_buffer()
-            ser.write(frame)
-            time.sleep(0.1)
-            resp = ser.read(256)
-
-            publish_json({
-                "result": "ok",
-                "cmd": cmd,
-                "channel": ch,
-                "state": state,
-                "response": hexdump(resp)
-            })
-
-        # ---------------- output all ----------------
-        elif cmd == "output_all":
-            state = data["state"]
-            results = []
-
-            for i in range(1, 9):
-                frame = build_relay_command(device_selected, i, state)
-                ser.reset_input_buffer()
-                ser.write(frame)
-                time.sleep(0.05)
-                resp = ser.read(256)
-
-                results.append({
-                    "channel": i,
-                    "response": hexdump(resp) if resp else None
-                })
-
-            publish_json({
-                "result": "ok",
-                "cmd": cmd,
-                "state": state,
-                "outputs": results
-            })
-
-        # ---------------- read input ----------------
-        elif cmd == "input":
-            ch = data["channel"]
-            frame = build_read_input(device_selected, ch)
-
-            ser.reset_input_buffer()
-            ser.write(frame)
-            time.sleep(0.1)
-            resp = ser.read(256)
-
-            publish_json({
-                "cmd": cmd,
-                "input": ch,
-                "state": "on" if resp and resp[4] == 1 else "off",
-                "raw": hexdump(resp)
-            })
-
-        # ---------------- status ----------------
-        elif cmd == "status":
-            target = data["target"]
-            states = []
-
-            for i in range(1, 9):
-                frame = (
-                    build_read_input(device_selected, i)
-                    if target == "inputs"
-                    else build_read_output(device_selected, i)
-                )
-
-                ser.reset_input_buffer()
-                ser.write(frame)
-                time.sleep(0.1)
-                resp = ser.read(256)
-
-                states.append({
-                    "channel": i,
-                    "state": "on" if resp and resp[4] == 1 else "off"
-                })
-
-            publish_json({
-                "cmd": cmd,
-                "target": target,
-                "states": states
-            })
+    resp = transact(ser, FRAMES[("out", "all", state)], WRITE_RESP_LEN)
+
+    # One FC 0x10 write covers channels 1-8: "response" is its echo, and
+    # "outputs" keeps the per-channel layout with that same echo in each
+    raw = hexdump(resp) if resp else None
+    results = [{"channel": i, "response": raw} for i in range(1, 9)]
+
+    publish_json({
+        "result": "ok",
+        "cmd": "output_all",
+        "state": state,
+        "response": raw,
+        "outputs": results
+    }, qos=1)
+
+# ---------------- read input ----------------
+def handle_input(data):
+    ch = data["channel"]
+    if type(ch) is not int:
+        raise ValueError("channel must be an integer")
+    frame = (
+        FRAMES.get(("in", ch))
+        or build_read_input(device_selected, ch)
+    )
 
-        else:
-            publish_json({
-                "result": "error",
-                "message": "Unknown command"
-            })
+    resp = transact(ser, frame, read_resp_len(1))
+    states = parse_states(resp, 1)
 
-    except Exception as e:
+    if states is None:
         publish_json({
             "result": "error",
-            "message": str(e)
-        })
+            "cmd": "input",
+            "input": ch,
+            "message": "Bad response" if resp else "No response (timeout)",
+            "raw": hexdump(resp)
+        }, qos=1)
+        return
+
+    publish_json({
+        "cmd": "input",
+        "input": ch,
+        "state": "on" if states[0] else "off",
+        "raw": hexdump(resp)
+    })
+
+# ---------------- status ----------------
+# Reused by every status sweep; only the "state" values change
+STATUS_BUF = [{"channel": i + 1, "state": "off"} for i in range(8)]
+
+def handle_status(data, copies=1):
+    # copies > 1 answers several identical queued requests with one read
+    target = data["target"]
+    frame = (
+        FRAMES[("in", "all")]
+        if target == "inputs"
+        else FRAMES[("outread", "all")]
+    )
+
+    resp = transact(ser, frame, read_resp_len(8))
+
+    on = parse_states(resp, 8) or [False] * 8
+    for i in range(8):
+        STATUS_BUF[i]["state"] = "on" if on[i] else "off"
+
+    payload = dumps({
+        "cmd": "status",
+        "target": target,
+        "states": STATUS_BUF
+    })
+    for _ in range(copies):
+        publish_json(payload)
+
+def handle_unknown(data):
+    publish_json(UNKNOWN_COMMAND_MSG, qos=1)
+
+# "cmd" value -> handler(data)
+HANDLERS = {
+    "output": handle_output,
+    "output_all": handle_output_all,
+    "input": handle_input,
+    "status": handle_status,
+}
+
+def process_command(data):
+    try:
+        handler = HANDLERS.get(data.get("cmd"), handle_unknown)
+        handler(data)
+    except Exception as e:
+        publish_error(e)
+
+def publish_error(e):
+    publish_json({
+        "result": "error",
+        "message": str(e)
+    }, qos=1)
+
+# -------------------
+# BATCHING
+# -------------------
+def is_simple_output(data):
+    # Single-channel writes that can be merged into an FC 0x10 frame
+    return (
+        isinstance(data, dict)
+        and data.get("cmd") == "output"
+        and type(data.get("channel")) is int
+        and 1 <= data["channel"] <= 8
+        and data.get("state") in ("on", "off")
+    )
+
+def status_target(data):
+    if isinstance(data, dict) and data.get("cmd") == "status":
+        return data.get("target")
+    return None
+
+def write_outputs(run):
+    # run: output commands for distinct channels. Contiguous channels
+    # share one FC 0x10 write; each command still gets its own ack,
+    # published in arrival order.
+    ordered = sorted(run, key=lambda d: d["channel"])
+    # channel -> hexdump of the reply, or the exception its group raised
+    raw_by_channel = {}
+    i = 0
+    while i < len(ordered):
+        j = i + 1
+        while j < len(ordered) and ordered[j]["channel"] == ordered[j - 1]["channel"] + 1:
+            j += 1
+        group = ordered[i:j]
+
+        if len(group) == 1:
+            frame = FRAMES[("out", group[0]["channel"], group[0]["state"])]
+        else:
+            frame = build_write_multiple(
+                device_selected,
+                group[0]["channel"],
+                [0x0100 if d["state"] == "on" else 0x0200 for d in group]
+            )
+        try:
+            raw = hexdump(transact(ser, frame, WRITE_RESP_LEN))
+        except Exception as e:
+            # Only this group failed; earlier groups still get their acks
+            raw = e
+
+        for d in group:
+            raw_by_channel[d["channel"]] = raw
+        i = j
+
+    for d in run:
+        raw = raw_by_channel[d["channel"]]
+        if isinstance(raw, Exception):
+            publish_error(raw)
+            continue
+        publish_json({
+            "result": "ok",
+            "cmd": "output",
+            "channel": d["channel"],
+            "state": d["state"],
+            "response": raw
+        }, qos=1)
+
+def process_batch(batch):
+    # Commands run in arrival order; only neighbouring commands of the
+    # same kind are merged, so a read never overtakes an earlier write.
+    i = 0
+    while i < len(batch):
+        data = batch[i]
+        j = i + 1
+
+        try:
+            if is_simple_output(data):
+                channels = {data["channel"]}
+                while (
+                    j < len(batch)
+                    and is_simple_output(batch[j])
+                    and batch[j]["channel"] not in channels
+                ):
+                    channels.add(batch[j]["channel"])
+                    j += 1
+                write_outputs(batch[i:j])
+
+            elif status_target(data) is not None:
+                target = status_target(data)
+                while j < len(batch) and status_target(batch[j]) == target:
+                    j += 1
+                try:
+                    handle_status(data, copies=j - i)
+                except Exception as e:
+                    # One reply per coalesced request, as on success
+                    for _ in range(j - i):
+                        publish_error(e)
+
+            else:
+                process_command(data)
+        except Exception as e:
+            publish_error(e)
+
+        i = j
 
 # -------------------
 # MQTT CALLBACKS
@@ -211,17 +327,18 @@ def process_command(data):
 def on_connect(client, userdata, flags, reason_code, properties):
     print("MQTT connected:", reason_code)
     client.subscribe("george/test/board/cmd")
-    publish_json({"status": "online"})
+    publish_json(ONLINE_MSG, qos=1)
 
 def on_message(client, userdata, msg):
     try:
-        payload = msg.payload.decode()
-        data = json.loads(payload)
-    except json.JSONDecodeError:
-        publish_json({"error": "Invalid JSON"})
+        data = loads(msg.payload)
+    except ValueError:
+        # JSONDecodeError (stdlib and orjson) and bad UTF-8 are ValueErrors
+        publish_json(INVALID_JSON_MSG, qos=1)
         return
 
-    process_command(data)
+    # Serial I/O happens on the worker, not on the MQTT network thread
+    command_queue.put(data)
 
 # -------------------
 # MAIN
@@ -231,14 +348,16 @@ def main():
     parser.add_argument("--port", required=True)
     parser.add_argument("--baud", type=int, default=9600)
     parser.add_argument("--device", type=int, default=1)
-    parser.add_argument("--timeout", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=0.05)
     args = parser.parse_args()
 
     global ser
     global device_selected
     global client
+    global FRAMES
 
     device_selected = args.device
+    FRAMES = build_frames(device_selected)
 
     try:
         ser = serial.Serial(
@@ -247,7 +366,8 @@ def main():
             bytesize=8,
             parity='N',
             stopbits=1,
-            timeout=args.timeout
+            timeout=args.timeout,
+            inter_byte_timeout=0.002
         )
     except Exception as e:
         print("Serial error:", e)
@@ -261,7 +381,11 @@ def main():
     client.on_message = on_message
 
     client.connect("yurir.org", 1883, 60)
-    client.loop_forever()
+    client.loop_start()
+    try:
+        serial_worker()
+    finally:
+        client.loop_stop()
 
 if __name__ == "__main__":
     main()
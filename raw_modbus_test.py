@@ -17,14 +17,13 @@ import serial
 import argparse
 import time
 import sys
-
-# Modbus function codes
-WRITE_REG = 0X06
-READ_REG  = 0X03
-
-def hexstr_to_bytes(s):
-    s = s.replace(' ','').replace('\n','')
-    return bytes.fromhex(s)
+from modbus_core import (
+    build_read_input,
+    build_read_output,
+    build_relay_command,
+    hexdump,
+    hexstr_to_bytes,
+)
 
 # Common example frames from your manual (slave=1)
 EXAMPLES = {
@@ -33,70 +32,7 @@ EXAMPLES = {
     'read_ch1'   : "01 03 00 01 00 01 D5 CA",
     'remove realationship': "01 06 00 FD 00 00 18 3A",
 }
-def crc16(data: bytes):
-    crc = 0xFFFF
-    for byte in data:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 1:
-                crc = (crc >> 1) ^ 0xA001
-            else:
-                crc >>= 1
-    return crc.to_bytes(2, byteorder='little')
-
-# Relay control base (no CRC yet)
-def build_relay_command(device, channel, action):
-    # channel: 1-8  → convert to register address
-    reg_hi = 0x00
-    reg_lo = channel  # 1..8
-
-    # action code from manual
-    # 01 = open (ON), 02 = close (OFF)
-    if action == "on":
-        data_hi, data_lo = 0x01, 0x00
-    elif action == "off":
-        data_hi, data_lo = 0x02, 0x00
-    else:
-        raise ValueError("action must be 'on' or 'off'")
-    
-    if channel > 8 or channel < 1:
-        raise ValueError("channel must be 1-8")
-
-    frame_wo_crc = bytes([device, WRITE_REG, reg_hi, reg_lo, data_hi, data_lo])
-
-    print("Frame without CRC:", hexdump(frame_wo_crc))
-    crc = crc16(frame_wo_crc)
-    return frame_wo_crc + crc
-
-
-def build_read_input(device, input_num):
-    # Inputs are 0x0081 - 0x0088
-    addr = 0x0080 + input_num
-    frame_wo_crc = bytes([
-        device,      # slave
-        READ_REG,      # read command
-        (addr >> 8) & 0xFF,
-        addr & 0xFF,
-        0x00, 0x01 # read one register
-    ])
-    crc = crc16(frame_wo_crc)
-    return frame_wo_crc + crc
-
-def builst_read_output(device, output_num):
-    # Outputs are 0x0001 - 0x0008
-    addr = output_num
-    frame_wo_crc = bytes([
-        device,      # slave
-        READ_REG,      # read command
-        (addr >> 8) & 0xFF,
-        addr & 0xFF,
-        0x00, 0x01 # read one register
-    ])
-    crc = crc16(frame_wo_crc)
-    return frame_wo_crc + crc
-
-def hexdump(b):
-    return ' '.join(f"{x:02X}" for x in b)
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -180,7 +116,7 @@ def main():
 
         elif cmd == "status out":
             for i in range(1, 9):
-                frame = builst_read_output(device_selected, i)
+                frame = build_read_output(device_selected, i)
                 ser.reset_input_buffer()
                 ser.write(frame)
                 time.sleep(0.1)